@@ -0,0 +1,27 @@
+"""job targets
+
+Revision ID: 3f1c5a7e9b24
+Revises: 92b7fe8c937b
+Create Date: 2026-10-15 10:12:31.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c5a7e9b24'
+down_revision = '92b7fe8c937b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('targets', postgresql.ARRAY(sa.Text(), dimensions=1), nullable=True))
+    op.execute("UPDATE job SET targets = ARRAY(SELECT json_array_elements_text(assignment::json->'targets'))")
+    op.alter_column('job', 'targets', nullable=False)
+
+
+def downgrade():
+    op.drop_column('job', 'targets')
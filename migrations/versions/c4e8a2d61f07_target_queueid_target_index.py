@@ -0,0 +1,23 @@
+"""target queueid target index
+
+Revision ID: c4e8a2d61f07
+Revises: 3f1c5a7e9b24
+Create Date: 2026-10-15 14:21:07.513290
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d61f07'
+down_revision = '3f1c5a7e9b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('target_queueid_target', 'target', ['queue_id', 'target'], unique=False)
+
+
+def downgrade():
+    op.drop_index('target_queueid_target', table_name='target')
@@ -21,7 +21,7 @@ from sner.agent.modules import load_agent_plugins
 from sner.lib import load_yaml
 from sner.server.extensions import api, db, jsglue, migrate, login_manager, oauth, webauthn
 from sner.server.parser import load_parser_plugins
-from sner.server.scheduler.core import ExclMatcher
+from sner.server.scheduler.core import get_excl_matcher
 from sner.server.sessions import FilesystemSessionInterface
 from sner.server.utils import error_response
 from sner.version import __version__
@@ -55,6 +55,11 @@ DEFAULT_CONFIG = {
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
     'SQLALCHEMY_DATABASE_URI': 'postgresql:///sner',
     'SQLALCHEMY_ECHO': False,
+    # multi-row inserts (enqueue, bulk upserts) sent in large pages, orm flushed updates batched
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        'executemany_mode': 'values_plus_batch',
+        'executemany_values_page_size': 10000,
+    },
 
     # sner web server
     'SNER_VAR': '/var/lib/sner',
@@ -223,8 +228,8 @@ def create_app(config_file='/etc/sner.yaml', config_env='SNER_CONFIG'):
     # load sner.plugin components
     load_agent_plugins()
     load_parser_plugins()
-    # check exclusion matcher config
-    ExclMatcher(app.config['SNER_EXCLUSIONS'])
+    # check exclusion matcher config and cache compiled matcher
+    get_excl_matcher(app)
 
     # initialize api blueprint; as side-effect overrides error handler
     app.config['API_SPEC_OPTIONS']['servers'] = [{'url': app.config['APPLICATION_ROOT']}]
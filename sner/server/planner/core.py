@@ -14,7 +14,8 @@ from time import sleep
 import psycopg2
 from flask import current_app
 from pytimeparse import parse as timeparse
-from sqlalchemy import select
+from sqlalchemy import any_, cast, select
+from sqlalchemy.dialects.postgresql import ARRAY as pg_ARRAY
 from sqlalchemy.orm.exc import NoResultFound
 
 from sner.lib import format_host_address, get_nested_key, TerminateContextMixin
@@ -116,7 +117,8 @@ def filter_external_hosts(hosts, nets):
     """filter addrs not belonging to nets list"""
 
     whitelist = [ip_network(net) for net in nets]
-    return [item for item in hosts if any(ip_address(item) in net for net in whitelist)]
+    # parse every address once, not for every whitelisted network
+    return [item for item, addr in zip(hosts, map(ip_address, hosts)) if any(addr in net for net in whitelist)]
 
 
 def filter_service_open(pidb):
@@ -188,8 +190,12 @@ class QueueHandler(Stage):  # pylint: disable=too-few-public-methods
     def task(self, data):
         """enqueue data/targets into all configured queues"""
 
-        already_queued = db.session.connection().execute(select(Target.target).filter(Target.queue == self.queue)).scalars().all()
-        enqueue = list(set(data) - set(already_queued))
+        data = set(data)
+        # probe only incoming targets instead of pulling whole queue to client
+        already_queued = db.session.connection().execute(
+            select(Target.target).filter(Target.queue_id == self.queue.id, Target.target == any_(cast(list(data), pg_ARRAY(db.Text))))
+        ).scalars().all()
+        enqueue = list(data - set(already_queued))
         QueueManager.enqueue(self.queue, enqueue)
         current_app.logger.info(f'{self.__class__.__name__} enqueued {len(enqueue)} targets to "{self.queue.name}"')
 
@@ -6,18 +6,21 @@ scheduler shared functions
 import json
 import re
 from abc import ABC, abstractmethod
-from collections import defaultdict, namedtuple
+from collections import Counter, defaultdict, namedtuple
+from copy import deepcopy
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from ipaddress import ip_address, ip_network, IPv4Address, IPv6Address
 from pathlib import Path
-from random import random
+from random import randrange
 from shutil import copy2
+from socket import inet_ntoa
 from uuid import uuid4
 
 import yaml
 from flask import current_app
-from sqlalchemy import cast, delete, distinct, func, select
+from sqlalchemy import cast, delete, exists, func, select
 from sqlalchemy.dialects.postgresql import ARRAY as pg_ARRAY, insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -29,6 +32,10 @@ from sner.server.scheduler.models import Heatmap, Job, Queue, Readynet, Target
 
 
 SCHEDULER_LOCK_NUMBER = 1
+HASHVAL_MASK_IPV4 = (2**32 - 1) ^ (2**8 - 1)
+HASHVAL_MASK_IPV6 = (2**128 - 1) ^ (2**80 - 1)
+SERVICE_TARGET_RE = re.compile(SERVICE_TARGET_REGEXP)
+SIXENUM_TARGET_RE = re.compile(SIXENUM_TARGET_REGEXP)
 
 
 def enumerate_network(arg):
@@ -40,22 +47,20 @@ def enumerate_network(arg):
     if network.prefixlen == network.max_prefixlen:
         return [str(network.network_address)]
 
-    # enumerate hosts
-    data = list(map(str, network.hosts()))
+    # enumerate whole range including network/bcast addresses, ipv4 range is
+    # formatted directly from integers to avoid per-host ipaddress overhead
+    first = int(network.network_address)
+    last = first + network.num_addresses
 
-    # add network/bcast addresses to range if it's not point-to-point link
-    if network.prefixlen < (network.max_prefixlen-1):
-        data.insert(0, str(network.network_address))
-        if network.version == 4:
-            data.append(str(network.broadcast_address))
-
-    return data
+    if network.version == 4:
+        return [inet_ntoa(addr.to_bytes(4, 'big')) for addr in range(first, last)]
+    return [str(IPv6Address(addr)) for addr in range(first, last)]
 
 
 def sixenum_target_boundaries(value):
     """returns tuple(first, last)"""
 
-    if not (mtmp := re.match(SIXENUM_TARGET_REGEXP, value)):
+    if not (mtmp := SIXENUM_TARGET_RE.match(value)):
         raise ValueError('not valid sixenum target')
 
     addr = mtmp.group('scan6dst')
@@ -107,6 +112,19 @@ class ExclMatcher():
         return False
 
 
+def get_excl_matcher(app):
+    """
+    get exclusion matcher for current app configuration. matcher is cached in
+    app.extensions and rebuilt only when exclusions config changes.
+    """
+
+    config = app.config['SNER_EXCLUSIONS']
+    cached = app.extensions.get('excl_matcher')
+    if (not cached) or (cached[0] != config):
+        cached = app.extensions['excl_matcher'] = (deepcopy(config), ExclMatcher(config))
+    return cached[1]
+
+
 class ExclMatcherImplBase(ABC):  # pylint: disable=too-few-public-methods
     """base interface which must  be implemented by all available matchers"""
 
@@ -144,15 +162,15 @@ class NetworkExclMatcher(ExclMatcherImplBase):  # pylint: disable=too-few-public
             return True
 
         # test value as service target
-        if mtmp := re.match(SERVICE_TARGET_REGEXP, value):
+        if mtmp := SERVICE_TARGET_RE.match(value):
             return self._test_addr(mtmp.group('host').replace('[', '').replace(']', ''))
 
         # test value as sixenum target
-        if mtmp := re.match(SIXENUM_TARGET_REGEXP, value):
+        if mtmp := SIXENUM_TARGET_RE.match(value):
             first, last = map(ip_address, sixenum_target_boundaries(value))
 
-            # first or last enum addr is in excluded range
-            if self._test_addr(first) or self._test_addr(last):
+            # first or last enum addr is in excluded range; already parsed, tested directly
+            if (first in self.match_to) or (last in self.match_to):
                 return True
 
             # excluded range could be smaller than enum, check if excluded range does not belong into enum itself
@@ -192,17 +210,15 @@ class QueueManager:
             enqueued_hashvals.add(thashval)
 
         if enqueued:
+            # targets and hashvals are prepared before lock is acquired to keep the critical section short
             SchedulerService.get_lock()
 
             conn = db.session.connection()
             conn.execute(pg_insert(Target), enqueued)
             hot_hashvals = set(SchedulerService.grep_hot_hashvals(enqueued_hashvals))
-            for thashval in (enqueued_hashvals - hot_hashvals):
-                conn.execute(
-                    pg_insert(Readynet)
-                    .values(queue_id=queue.id, hashval=thashval)
-                    .on_conflict_do_nothing(constraint='readynet_pkey')
-                )
+            readynets = [{'queue_id': queue.id, 'hashval': thashval} for thashval in (enqueued_hashvals - hot_hashvals)]
+            if readynets:
+                conn.execute(pg_insert(Readynet).values(readynets).on_conflict_do_nothing(constraint='readynet_pkey'))
             db.session.commit()
 
             SchedulerService.release_lock()
@@ -252,7 +268,7 @@ class JobManager:
     @staticmethod
     def create(queue, assigned_targets):
         """
-        create job for queue with targets
+        create job for queue with targets, caller must commit the transaction
 
         :return: agent assignment data
         :rtype: dict
@@ -263,20 +279,29 @@ class JobManager:
             'config': {} if queue.config is None else yaml.safe_load(queue.config),
             'targets': assigned_targets
         }
-        db.session.add(Job(id=assignment['id'], queue=queue, assignment=json.dumps(assignment)))
-        db.session.commit()
+        db.session.add(Job(id=assignment['id'], queue=queue, assignment=json.dumps(assignment), targets=assigned_targets))
         return assignment
 
     @staticmethod
-    def finish(job, retval, output):
-        """writeback job results"""
+    def write_output(job, output):
+        """write job output file; written to temporary file and renamed, so partial output is never visible"""
 
         opath = Path(job.output_abspath)
         opath.parent.mkdir(parents=True, exist_ok=True)
-        opath.write_bytes(output)
+        tmppath = opath.with_name(f'.{opath.name}.{uuid4()}')
+        try:
+            tmppath.write_bytes(output)
+            tmppath.replace(opath)
+        except OSError:  # pragma: no cover  ; wont test
+            tmppath.unlink(missing_ok=True)
+            raise
+
+    @staticmethod
+    def finish(job, retval):
+        """writeback job results, caller must commit the transaction"""
+
         job.retval = retval
         job.time_end = datetime.utcnow()
-        db.session.commit()
 
     @staticmethod
     def reconcile(job):
@@ -289,11 +314,13 @@ class JobManager:
             current_app.logger.error('cannot reconcile completed job %s', job.id)
             raise RuntimeError('cannot reconcile completed job')
 
+        hashvals = list(map(SchedulerService.hashval, job.targets))
+
         SchedulerService.get_lock()
 
         job.retval = -1
-        for target in json.loads(job.assignment)['targets']:
-            SchedulerService.heatmap_pop(SchedulerService.hashval(target))
+        SchedulerService.heatmap_pop(hashvals)
+        db.session.commit()
 
         SchedulerService.release_lock()
 
@@ -301,7 +328,7 @@ class JobManager:
     def repeat(job):
         """job repeat; reschedule targets"""
 
-        QueueManager.enqueue(job.queue, json.loads(job.assignment)['targets'])
+        QueueManager.enqueue(job.queue, job.targets)
 
     @staticmethod
     def parse(job):
@@ -360,7 +387,6 @@ class SchedulerService:
 
     TIMEOUT_JOB_ASSIGN = 3
     TIMEOUT_JOB_OUTPUT = 30
-    HEATMAP_GC_PROBABILITY = 0.1
 
     @staticmethod
     def get_lock(timeout=0):
@@ -383,80 +409,106 @@ class SchedulerService:
         db.session.execute('SELECT pg_advisory_unlock(:locknum);', {'locknum': SCHEDULER_LOCK_NUMBER})
 
     @staticmethod
+    @lru_cache(maxsize=65536)
     def hashval(value):
         """computes rate-limit heatmap hash value"""
 
-        if mtmp := re.match(SERVICE_TARGET_REGEXP, value):
+        if mtmp := SERVICE_TARGET_RE.match(value):
             value = mtmp.group('host')
             if (value[0] == '[') and (value[-1] == ']'):
                 value = value[1:-1]
 
-        if mtmp := re.match(SIXENUM_TARGET_REGEXP, value):
+        if mtmp := SIXENUM_TARGET_RE.match(value):
             value = mtmp.group('scan6dst').split('-')[0]
 
         try:
             addr = ip_address(value)
-            if isinstance(addr, IPv4Address):
-                return str(ip_network(f'{ip_address(value)}/24', strict=False))
-            if isinstance(addr, IPv6Address):
-                return str(ip_network(f'{ip_address(value)}/48', strict=False))
         except ValueError:
-            pass
+            return value
 
-        return value
+        # mask address to network prefix directly, avoids reparsing address as network
+        if isinstance(addr, IPv4Address):
+            return f'{IPv4Address(int(addr) & HASHVAL_MASK_IPV4)}/24'
+        return f'{IPv6Address(int(addr) & HASHVAL_MASK_IPV6)}/48'
 
     @staticmethod
-    def heatmap_put(hashval):
-        """account value (increment counter) in heatmap and update readynets"""
+    def _heatmap_update(counts, sign):
+        """
+        add (sign 1) or subtract (sign -1) aggregated counts to heatmap counters in single upsert
 
-        conn = db.session.connection()
-        heat_count = conn.execute(
-            pg_insert(Heatmap)
-            .values(hashval=hashval, count=1)
-            .on_conflict_do_update(constraint='heatmap_pkey', set_=dict(count=Heatmap.count+1))
-            .returning(Heatmap.count)
-        ).scalar()
+        :return: updated heatmap counters
+        :rtype: list of rows (hashval, count)
+        """
 
-        if current_app.config['SNER_HEATMAP_HOT_LEVEL'] and (heat_count >= current_app.config['SNER_HEATMAP_HOT_LEVEL']):
-            conn.execute(delete(Readynet).filter(Readynet.hashval == hashval))
+        if not counts:
+            return []
 
-        db.session.commit()
-        return heat_count
+        stmt = pg_insert(Heatmap).values([{'hashval': hashval, 'count': count} for hashval, count in sorted(counts.items())])
+        return db.session.connection().execute(
+            stmt
+            .on_conflict_do_update(constraint='heatmap_pkey', set_={'count': Heatmap.count + sign * stmt.excluded.count})
+            .returning(Heatmap.hashval, Heatmap.count)
+        ).all()
 
-    @classmethod
-    def heatmap_pop(cls, hashval):
-        """account value (decrement counter) in heatmap and update readynets"""
+    @staticmethod
+    def heatmap_put(hashvals):
+        """
+        account values (increment counters) in heatmap and update readynets.
+        heatmap_* must be called within a transaction the caller will commit.
+        """
 
         conn = db.session.connection()
-        heat_count = conn.execute(
-            pg_insert(Heatmap)
-            .values(hashval=hashval, count=1)
-            .on_conflict_do_update(constraint='heatmap_pkey', set_=dict(count=Heatmap.count-1))
-            .returning(Heatmap.count)
-        ).scalar()
+        heat = SchedulerService._heatmap_update(Counter(hashvals), 1)
 
-        if random() < cls.HEATMAP_GC_PROBABILITY:
-            conn.execute(delete(Heatmap).filter(Heatmap.count == 0))
+        hot_level = current_app.config['SNER_HEATMAP_HOT_LEVEL']
+        if hot_level:
+            hot_hashvals = [item.hashval for item in heat if item.count >= hot_level]
+            if hot_hashvals:
+                conn.execute(delete(Readynet).filter(Readynet.hashval.in_(hot_hashvals)))
 
-        if current_app.config['SNER_HEATMAP_HOT_LEVEL'] and (heat_count+1 == current_app.config['SNER_HEATMAP_HOT_LEVEL']):
-            for queue_id in db.session.execute(select(func.distinct(Target.queue_id)).filter(Target.hashval == hashval)).scalars().all():
-                conn.execute(pg_insert(Readynet).values(queue_id=queue_id, hashval=hashval))
+    @staticmethod
+    def heatmap_pop(hashvals):
+        """
+        account values (decrement counters) in heatmap and update readynets.
+        heatmap_* must be called within a transaction the caller will commit.
+        """
 
-        db.session.commit()
-        return heat_count
+        conn = db.session.connection()
+        counts = Counter(hashvals)
+        heat = SchedulerService._heatmap_update(counts, -1)
+
+        # drop counters which cooled down completely
+        zero_hashvals = [item.hashval for item in heat if item.count == 0]
+        if zero_hashvals:
+            conn.execute(delete(Heatmap).filter(Heatmap.hashval.in_(zero_hashvals), Heatmap.count == 0))
+
+        hot_level = current_app.config['SNER_HEATMAP_HOT_LEVEL']
+        if hot_level:
+            # readynet becomes cool when counter crosses down the hot level, activate it for all queues
+            cool_hashvals = [item.hashval for item in heat if item.count < hot_level <= item.count + counts[item.hashval]]
+            if cool_hashvals:
+                conn.execute(
+                    pg_insert(Readynet)
+                    .from_select(
+                        ['queue_id', 'hashval'],
+                        select(Target.queue_id, Target.hashval).filter(Target.hashval.in_(cool_hashvals)).distinct()
+                    )
+                    .on_conflict_do_nothing(constraint='readynet_pkey')
+                )
 
     @staticmethod
     def grep_hot_hashvals(hashvals):
         """get hot hashvals among argument list"""
 
-        if not current_app.config['SNER_HEATMAP_HOT_LEVEL']:
+        hot_level = current_app.config['SNER_HEATMAP_HOT_LEVEL']
+        if not hot_level:
             return []
 
         return db.session.connection().execute(
             select(Heatmap.hashval)
             .filter(
                 Heatmap.hashval.in_(hashvals),
-                Heatmap.count >= current_app.config['SNER_HEATMAP_HOT_LEVEL']
+                Heatmap.count >= hot_level
             )
         ).scalars().all()
 
@@ -478,7 +530,7 @@ class SchedulerService:
         query = select(Queue).filter(
             Queue.active,
             Queue.reqs.contained_by(cast(client_caps, pg_ARRAY(db.String))),
-            Queue.id.in_(select(distinct(Readynet.queue_id)))
+            exists().where(Readynet.queue_id == Queue.id)
         )
         if queue_name:
             query = query.filter(Queue.name == queue_name)
@@ -486,41 +538,46 @@ class SchedulerService:
         return db.session.execute(query).scalars().first()
 
     @staticmethod
-    def _pop_random_target(queue):
+    def _pop_random_target(queue, hot_hashvals):
         """
         pop random target from queue and update readynet info
 
+        :param hot_hashvals: hashvals which became hot during current assignment, readynets are not yet deactivated
         :return: random target properties as tuple
         :rtype: sner.server.scheduler.core.RandomTarget
         """
 
         conn = db.session.connection()
+        readynet_filter = (Readynet.queue_id == queue.id, Readynet.hashval.not_in(hot_hashvals))
 
+        # random row is selected by count and offset, avoids sorting all candidate rows by random()
+        readynet_count = conn.execute(select(func.count()).select_from(Readynet).filter(*readynet_filter)).scalar()
+        if not readynet_count:
+            return None
         readynet_hashval = conn.execute(
-            select(Readynet.hashval).filter(Readynet.queue_id == queue.id).order_by(func.random()).limit(1)
+            select(Readynet.hashval).filter(*readynet_filter).offset(randrange(readynet_count)).limit(1)
         ).scalar()
-        if not readynet_hashval:
-            return None
 
+        target_count = conn.execute(
+            select(func.count(Target.id)).filter(Target.queue_id == queue.id, Target.hashval == readynet_hashval)
+        ).scalar()
+        # select and delete target in single statement, selection is consistent under scheduler lock
         target_id, target = conn.execute(
-            select(Target.id, Target.target)
-            .filter(Target.queue_id == queue.id, Target.hashval == readynet_hashval)
-            .order_by(func.random())
-            .limit(1)
-        ).first()
+            delete(Target)
+            .filter(Target.id == (
+                select(Target.id)
+                .filter(Target.queue_id == queue.id, Target.hashval == readynet_hashval)
+                .offset(randrange(target_count))
+                .limit(1)
+                .scalar_subquery()
+            ))
+            .returning(Target.id, Target.target)
+        ).one()
 
-        conn.execute(delete(Target).filter(Target.id == target_id))
         # prune readynet if no targets left for current queue
-        conn.execute(
-            delete(Readynet)
-            .filter(
-                Readynet.queue_id == queue.id,
-                Readynet.hashval == readynet_hashval,
-                select(func.count(Target.id)).filter(Target.queue_id == queue.id, Target.hashval == readynet_hashval).scalar_subquery() == 0
-            )
-        )
+        if target_count == 1:
+            conn.execute(delete(Readynet).filter(Readynet.queue_id == queue.id, Readynet.hashval == readynet_hashval))
 
-        db.session.commit()
         return RandomTarget(target_id, target, readynet_hashval)
 
     @classmethod
@@ -537,28 +594,48 @@ class SchedulerService:
             * deactivate readynet for all queues if it becomes hot
         """
 
-        cls.get_lock(cls.TIMEOUT_JOB_ASSIGN)
-
         assignment = {}  # nowork
         assigned_targets = []
-        blacklist = ExclMatcher(current_app.config['SNER_EXCLUSIONS'])
+        assigned_hashvals = []
+        blacklist = get_excl_matcher(current_app)
+        hot_level = current_app.config['SNER_HEATMAP_HOT_LEVEL']
+        hot_hashvals = set()
+
+        cls.get_lock(cls.TIMEOUT_JOB_ASSIGN)
 
         queue = cls._get_assignment_queue(queue_name, client_caps)
         if not queue:
             SchedulerService.release_lock()
             return assignment
 
+        # only hashvals close enough to hot level can become hot during current assignment,
+        # counts of other hashvals are underestimated from zero, which never crosses hot level
+        heat = defaultdict(int)
+        if hot_level:
+            heat.update(db.session.execute(
+                select(Heatmap.hashval, Heatmap.count).filter(Heatmap.count >= hot_level - queue.group_size)
+            ).all())
+
         while len(assigned_targets) < queue.group_size:
-            rtarget = cls._pop_random_target(queue)
+            rtarget = cls._pop_random_target(queue, hot_hashvals)
             if not rtarget:
                 break
             if blacklist.match(rtarget.target):
                 continue
             assigned_targets.append(rtarget.target)
-            cls.heatmap_put(rtarget.hashval)
+            assigned_hashvals.append(rtarget.hashval)
+
+            # heatmap and readynets are updated in bulk after selection, but hot
+            # readynets must not be selected again within current assignment
+            if hot_level:
+                heat[rtarget.hashval] += 1
+                if heat[rtarget.hashval] >= hot_level:
+                    hot_hashvals.add(rtarget.hashval)
 
+        cls.heatmap_put(assigned_hashvals)
         if assigned_targets:
             assignment = JobManager.create(queue, assigned_targets)
+        db.session.commit()
 
         cls.release_lock()
         return assignment
@@ -572,11 +649,15 @@ class SchedulerService:
             * if readynet of the target becomes cool activate it for all queues
         """
 
+        # output file and hashvals are prepared before lock is acquired to keep the critical section short
+        JobManager.write_output(job, output)
+        hashvals = list(map(cls.hashval, job.targets))
+
         cls.get_lock(cls.TIMEOUT_JOB_OUTPUT)
 
-        JobManager.finish(job, retval, output)
-        for target in json.loads(job.assignment)['targets']:
-            cls.heatmap_pop(cls.hashval(target))
+        JobManager.finish(job, retval)
+        cls.heatmap_pop(hashvals)
+        db.session.commit()
 
         cls.release_lock()
 
@@ -600,14 +681,11 @@ class SchedulerService:
             hot_hashvals = set()
 
         # for all target hashvals except over limit insert as readynet for all queues
-        all_hashvals = set(conn.execute(select(func.distinct(Target.hashval))).scalars().all())
-        for thashval in (all_hashvals - hot_hashvals):
-            for queue_id in conn.execute(select(func.distinct(Target.queue_id)).filter(Target.hashval == thashval)).scalars().all():
-                conn.execute(
-                    pg_insert(Readynet)
-                    .values(queue_id=queue_id, hashval=thashval)
-                    .on_conflict_do_nothing(constraint='readynet_pkey')
-                )
+        conn.execute(
+            pg_insert(Readynet)
+            .from_select(['queue_id', 'hashval'], select(Target.queue_id, Target.hashval).filter(Target.hashval.not_in(hot_hashvals)).distinct())
+            .on_conflict_do_nothing(constraint='readynet_pkey')
+        )
 
         db.session.commit()
         cls.release_lock()
@@ -624,8 +702,9 @@ class SchedulerService:
         cls.get_lock()
 
         ref_heatmap = defaultdict(int)
-        for job in Job.query.filter(Job.retval == None).all():  # noqa: E711  pylint: disable=singleton-comparison
-            for target in json.loads(job.assignment)['targets']:
+        query = select(Job.targets).filter(Job.retval == None)  # noqa: E711  pylint: disable=singleton-comparison
+        for targets in db.session.execute(query).scalars():
+            for target in targets:
                 ref_heatmap[SchedulerService.hashval(target)] += 1
 
         db_heatmap = {
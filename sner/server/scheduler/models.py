@@ -50,7 +50,8 @@ class Target(db.Model):
 
     __table_args__ = (
         Index('target_queueid_hashval', 'queue_id', 'hashval'),  # get_assignment: select random target from queue
-        Index('target_hashval', 'hashval')  # job_done: enable readynet on all queues
+        Index('target_hashval', 'hashval'),  # job_done: enable readynet on all queues
+        Index('target_queueid_target', 'queue_id', 'target')  # planner: filter already queued targets
     )
 
     def __repr__(self):
@@ -78,7 +79,7 @@ class Readynet(db.Model):
     hashval = db.Column(db.String, nullable=False)
 
     __table_args__ = (
-        PrimaryKeyConstraint('queue_id', 'hashval', name='readynet_pkey'),  # enqueue: ensure uniqueness
+        PrimaryKeyConstraint('queue_id', 'hashval', name='readynet_pkey'),  # enqueue: ensure uniqueness, get_assignment: select queue
         Index('readynet_hashval', 'hashval')  # get_assignment: remove readynet when hot
     )
 
@@ -92,6 +93,7 @@ class Job(db.Model):
     id = db.Column(db.String(36), primary_key=True)
     queue_id = db.Column(db.Integer, db.ForeignKey('queue.id', ondelete='CASCADE'))
     assignment = db.Column(db.Text, nullable=False)
+    targets = db.Column(postgresql.ARRAY(db.Text, dimensions=1), nullable=False, default=list)  # denormalized assignment targets
     retval = db.Column(db.Integer)
     time_start = db.Column(db.DateTime, default=datetime.utcnow)
     time_end = db.Column(db.DateTime)
@@ -10,6 +10,8 @@ from pathlib import Path
 import click
 from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy import delete
+from sqlalchemy.orm import joinedload
 
 from sner.lib import format_host_address
 from sner.server.extensions import db
@@ -68,9 +70,11 @@ def storage_import(path, parser, **kwargs):
 def storage_flush():
     """flush all objects from storage"""
 
-    db.session.query(Host).delete()
-    db.session.query(Versioninfo).delete()
-    db.session.query(Vulnsearch).delete()
+    # single bulk statement per table, dependent objects are removed by database level cascades
+    conn = db.session.connection()
+    conn.execute(delete(Host))
+    conn.execute(delete(Versioninfo))
+    conn.execute(delete(Vulnsearch))
     db.session.commit()
 
 
@@ -111,8 +115,11 @@ def storage_service_list(**kwargs):
         return format_host_address(svc.host.address)
 
     def get_data(svc):
-        """return common data as dict"""
-        return {'proto': svc.proto, 'port': svc.port, 'name': svc.name, 'state': svc.state, 'info': json.dumps(svc.info)}
+        """return common data as dict, info is serialized only for long format"""
+        data = {'proto': svc.proto, 'port': svc.port, 'name': svc.name, 'state': svc.state}
+        if kwargs['long']:
+            data['info'] = json.dumps(svc.info)
+        return data
 
     if kwargs['long'] and kwargs['short']:
         current_app.logger.error('--short and --long are mutualy exclusive options')
@@ -130,7 +137,8 @@ def storage_service_list(**kwargs):
     elif kwargs['long']:
         fmt = '{proto}://{host}:{port} {name} {state} {info}'
 
-    for tmp in query.all():
+    # stream results with server-side cursor, host is joined upfront to avoid per-row lazy loads
+    for tmp in query.options(joinedload(Service.host)).yield_per(1000):
         print(fmt.format(**get_data(tmp), host=get_host(tmp, kwargs['hostnames'])))
 
 
@@ -8,12 +8,14 @@ from csv import DictWriter, QUOTE_ALL
 from datetime import datetime, timedelta
 from http import HTTPStatus
 from io import StringIO
+from ipaddress import ip_address
 from typing import Union
 
 from flask import current_app
 from pytimeparse import parse as timeparse
-from sqlalchemy import case, cast, delete, func, or_, not_, select, update
+from sqlalchemy import case, cast, delete, exists, func, or_, not_, select, update
 from sqlalchemy.dialects.postgresql import ARRAY as pg_ARRAY
+from sqlalchemy.orm import aliased, contains_eager
 from sqlalchemy.sql.functions import coalesce
 
 from sner.lib import format_host_address
@@ -377,14 +379,61 @@ class StorageManager:
                 print(f'storage update new note: {inote}')
 
     @staticmethod
-    def import_parsed(pidb, addtags=None):  # pylint: disable=too-many-branches
+    def _prefetch_existing(addresses):
+        """
+        prefetch all existing objects related to imported addresses in few bulk queries
+        instead of querying for each imported item
+
+        :return: hosts, services, vulns and notes dicts keyed by address and identifying attributes
+        :rtype: tuple
+        """
+
+        hosts, services, vulns, notes = {}, {}, {}, {}
+        for host in Host.query.filter(Host.address.in_(addresses)).all():
+            hosts[ip_address(host.address)] = host
+        for service in Service.query.join(Host).filter(Host.address.in_(addresses)).options(contains_eager(Service.host)).all():
+            services[(ip_address(service.host.address), service.proto, service.port)] = service
+        for vuln in Vuln.query.join(Host, Vuln.host_id == Host.id).filter(Host.address.in_(addresses)).options(contains_eager(Vuln.host)).all():
+            vulns[(
+                ip_address(vuln.host.address),
+                vuln.name,
+                vuln.xtype,
+                vuln.service.proto if vuln.service else None,
+                vuln.service.port if vuln.service else None,
+                vuln.via_target
+            )] = vuln
+        for note in Note.query.join(Host, Note.host_id == Host.id).filter(Host.address.in_(addresses)).options(contains_eager(Note.host)).all():
+            notes[(
+                ip_address(note.host.address),
+                note.xtype,
+                note.service.proto if note.service else None,
+                note.service.port if note.service else None,
+                note.via_target
+            )] = note
+
+        return hosts, services, vulns, notes
+
+    @staticmethod
+    def _lookup_host_service(pidb, item, hosts, services):
+        """lookup prefetched/imported host and optional service for parsed vuln or note"""
+
+        host_key = ip_address(pidb.hosts.by.iid[item.host_iid].address)
+        iservice = pidb.services.by.iid[item.service_iid] if (item.service_iid is not None) else None
+        return host_key, hosts[host_key], services[(host_key, iservice.proto, iservice.port)] if iservice else None
+
+    @staticmethod
+    def import_parsed(pidb, addtags=None):  # pylint: disable=too-many-branches,too-many-locals
         """import"""
 
+        # indexes are maintained for new objects during import
+        hosts, services, vulns, notes = StorageManager._prefetch_existing(list({ihost.address for ihost in pidb.hosts}))
+
         # import hosts
         for ihost in pidb.hosts:
-            host = db_host(ihost.address)
+            host_key = ip_address(ihost.address)
+            host = hosts.get(host_key)
             if not host:
-                host = Host(address=ihost.address)
+                host = hosts[host_key] = Host(address=ihost.address)
                 db.session.add(host)
                 current_app.logger.info(f'storage update new host {host}')
             host.update(ihost)
@@ -392,77 +441,59 @@ class StorageManager:
                 tag_add(host, addtags)
 
             if ihost.hostnames:
-                note = db_note(ihost.address, 'hostnames')
+                note_key = (host_key, 'hostnames', None, None, None)
+                note = notes.get(note_key)
                 if not note:
-                    note = Note(host=host, xtype='hostnames', data='[]')
+                    note = notes[note_key] = Note(host=host, xtype='hostnames', data='[]')
                     db.session.add(note)
                 note.data = json.dumps(list(set(json.loads(note.data) + ihost.hostnames)))
-        db.session.commit()
 
         # import services
         for iservice in pidb.services:
-            host = db_host(pidb.hosts.by.iid[iservice.host_iid].address, flag_required=True)
-            service = db_service(host.address, iservice.proto, iservice.port)
+            host_key = ip_address(pidb.hosts.by.iid[iservice.host_iid].address)
+            host = hosts[host_key]
+            service = services.get((host_key, iservice.proto, iservice.port))
             if not service:
-                service = Service(host=host, proto=iservice.proto, port=iservice.port)
+                service = services[(host_key, iservice.proto, iservice.port)] = Service(host=host, proto=iservice.proto, port=iservice.port)
                 db.session.add(service)
                 current_app.logger.info(f'storage update new service {service}')
             service.update(iservice)
             if addtags:
                 tag_add(service, addtags)
-        db.session.commit()
 
         # import vulns
         for ivuln in pidb.vulns:
-            host = db_host(pidb.hosts.by.iid[ivuln.host_iid].address, flag_required=True)
-            service = (
-                db_service(
-                    host.address,
-                    pidb.services.by.iid[ivuln.service_iid].proto,
-                    pidb.services.by.iid[ivuln.service_iid].port,
-                    flag_required=True
-                )
-                if ivuln.service_iid is not None
-                else None
-            )
-            vuln = db_vuln(
-                host.address,
+            host_key, host, service = StorageManager._lookup_host_service(pidb, ivuln, hosts, services)
+            vuln_key = (
+                host_key,
                 ivuln.name,
                 ivuln.xtype,
                 service.proto if service else None,
                 service.port if service else None,
                 ivuln.via_target
             )
+            vuln = vulns.get(vuln_key)
             if not vuln:
-                vuln = Vuln(host=host, name=ivuln.name, xtype=ivuln.xtype, service=service, via_target=ivuln.via_target)
+                vuln = vulns[vuln_key] = Vuln(host=host, name=ivuln.name, xtype=ivuln.xtype, service=service, via_target=ivuln.via_target)
                 db.session.add(vuln)
                 current_app.logger.info(f'storage update new vuln {vuln}')
             vuln.update(ivuln)
             if addtags:
                 tag_add(vuln, addtags)
-        db.session.commit()
 
         # import notes
         for inote in pidb.notes:
-            host = db_host(pidb.hosts.by.iid[inote.host_iid].address, flag_required=True)
-            service = (
-                db_service(
-                    host.address,
-                    pidb.services.by.iid[inote.service_iid].proto,
-                    pidb.services.by.iid[inote.service_iid].port,
-                    flag_required=True
-                )
-                if inote.service_iid is not None
-                else None
-            )
-            note = db_note(host.address, inote.xtype, service.proto if service else None, service.port if service else None, inote.via_target)
+            host_key, host, service = StorageManager._lookup_host_service(pidb, inote, hosts, services)
+            note_key = (host_key, inote.xtype, service.proto if service else None, service.port if service else None, inote.via_target)
+            note = notes.get(note_key)
             if not note:
-                note = Note(host=host, xtype=inote.xtype, service=service, via_target=inote.via_target)
+                note = notes[note_key] = Note(host=host, xtype=inote.xtype, service=service, via_target=inote.via_target)
                 db.session.add(note)
                 current_app.logger.info(f'storage update new note {note}')
             note.update(inote)
             if addtags:
                 tag_add(note, addtags)
+
         db.session.commit()
 
     @staticmethod
@@ -515,48 +546,44 @@ class StorageManager:
     @staticmethod
     def cleanup_storage():
         """clean up storage from various import artifacts"""
-        # bypassing ORM for performance reasons
+        # bypassing ORM for performance reasons, each step is a single bulk statement
         conn = db.session.connection()
 
         # remove any but open:* state services
-        services_to_delete = conn.execute(select(
-            Service.id,
-            Service.proto,
-            Service.port,
-            Host.address.label('host_address')
-        ).join(Host).filter(not_(Service.state.ilike('open:%')))).all()
-        for service in services_to_delete:
+        deleted_services = conn.execute(
+            delete(Service)
+            .where(Service.host_id == Host.id, not_(Service.state.ilike('open:%')))
+            .returning(Service.id, Service.proto, Service.port, Host.address.label('host_address'))
+        ).all()
+        for service in deleted_services:
             current_app.logger.info(
                     'storage update delete service '
                     f'<Service {service.id}: {format_host_address(service.host_address)} {service.proto}.{service.port}>'
             )
-        conn.execute(delete(Service).filter(Service.id.in_([x[0] for x in services_to_delete])))
-
-        # remove hosts without any data attribute, service, vuln or note
-        hosts_noinfo = conn.execute(
-            select(Host.id).filter(or_(Host.os == '', Host.os == None), or_(Host.comment == '', Host.comment == None))  # noqa: E501,E711  pylint: disable=singleton-comparison
-        ).scalars().all()
-        hosts_noservices = conn.execute(
-            select(Host.id).outerjoin(Service).having(func.count(Service.id) == 0).group_by(Host.id)
-        ).scalars().all()
-        hosts_novulns = conn.execute(select(Host.id).outerjoin(Vuln).having(func.count(Vuln.id) == 0).group_by(Host.id)).scalars().all()
-        hosts_nonotes = conn.execute(select(Host.id).outerjoin(Note).having(func.count(Note.id) == 0).group_by(Host.id)).scalars().all()
-
-        hosts_to_delete = list(set(hosts_noinfo) & set(hosts_noservices) & set(hosts_novulns) & set(hosts_nonotes))
-        for host in conn.execute(select(Host.id, Host.address, Host.hostname).filter(Host.id.in_(hosts_to_delete))).all():
-            current_app.logger.info(f'storage update delete host <Host {host.id}: {host.address} {host.hostname}>')
-        conn.execute(delete(Host).filter(Host.id.in_(hosts_to_delete)))
 
+        # remove hosts without any data attribute, service, vuln or note,
         # also remove all hosts not having any info but one note xtype hostnames
-        hosts_only_one_note = conn.execute(select(Host.id).outerjoin(Note).having(func.count(Note.id) == 1).group_by(Host.id)).scalars().all()
-        hosts_only_note_hostnames = conn.execute(
-            select(Host.id).join(Note).filter(Host.id.in_(hosts_only_one_note), Note.xtype == 'hostnames')
-        ).scalars().all()
-
-        hosts_to_delete = list(set(hosts_noinfo) & set(hosts_noservices) & set(hosts_novulns) & set(hosts_only_note_hostnames))
-        for host in conn.execute(select(Host.id, Host.address, Host.hostname).filter(Host.id.in_(hosts_to_delete))).all():
+        other_note = aliased(Note)
+        deleted_hosts = conn.execute(
+            delete(Host)
+            .where(
+                or_(Host.os == '', Host.os == None),  # noqa: E711  pylint: disable=singleton-comparison
+                or_(Host.comment == '', Host.comment == None),  # noqa: E711  pylint: disable=singleton-comparison
+                ~exists().where(Service.host_id == Host.id),
+                ~exists().where(Vuln.host_id == Host.id),
+                or_(
+                    ~exists().where(Note.host_id == Host.id),
+                    exists().where(
+                        Note.host_id == Host.id,
+                        Note.xtype == 'hostnames',
+                        ~exists().where(other_note.host_id == Note.host_id, other_note.id != Note.id)
+                    )
+                )
+            )
+            .returning(Host.id, Host.address, Host.hostname)
+        ).all()
+        for host in deleted_hosts:
             current_app.logger.info(f'storage update delete host <Host {host.id}: {host.address} {host.hostname}>')
-        conn.execute(delete(Host).filter(Host.id.in_(hosts_to_delete)))
 
         db.session.commit()
         db.session.expire_all()
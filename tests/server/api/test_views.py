@@ -139,14 +139,14 @@ def test_v2_scheduler_job_assign_route_caps(api_agent, queue_factory, target_fac
 def test_v2_scheduler_job_output_route(api_agent, job):
     """job output route test"""
 
-    with patch.object(sner.server.scheduler.core.SchedulerService, 'HEATMAP_GC_PROBABILITY', 1.0):
-        response = api_agent.post_json(
-            url_for('api.v2_scheduler_job_output_route'),
-            {'id': job.id, 'retval': 12345, 'output': base64.b64encode(b'a-test-file-contents').decode('utf-8')}
-        )
+    response = api_agent.post_json(
+        url_for('api.v2_scheduler_job_output_route'),
+        {'id': job.id, 'retval': 12345, 'output': base64.b64encode(b'a-test-file-contents').decode('utf-8')}
+    )
     assert response.status_code == HTTPStatus.OK
     assert job.retval == 12345
     assert Path(job.output_abspath).read_text(encoding='utf-8') == 'a-test-file-contents'
+    assert Heatmap.query.count() == 0
 
 
 def test_v2_scheduler_job_output_route_invalidrequest(api_agent):
@@ -160,6 +160,17 @@ def test_queuehandler_nxqueue(app, job_completed_nmap):  # pylint: disable=unuse
         StorageLoader('nx queue')
 
 
+def test_queuehandler_task(app, queue_factory, target_factory):  # pylint: disable=unused-argument
+    """test QueueHandler task enqueues only targets not already queued"""
+
+    queue = queue_factory.create(name='test queue')
+    target_factory.create(queue=queue, target='127.0.0.1', hashval=SchedulerService.hashval('127.0.0.1'))
+
+    StorageLoader(queue.name).task(['127.0.0.1', '127.0.0.2'])
+
+    assert sorted(item.target for item in Target.query.filter(Target.queue_id == queue.id).all()) == ['127.0.0.1', '127.0.0.2']
+
+
 def test_storagecleanup(app, host_factory, service_factory):  # pylint: disable=unused-argument
     """test planners cleanup storage stage"""
 
@@ -3,6 +3,7 @@
 scheduler core tests
 """
 
+import json
 from ipaddress import ip_address, ip_network
 from pathlib import Path
 
@@ -11,7 +12,15 @@ import yaml
 from flask import current_app
 
 from sner.server.extensions import db
-from sner.server.scheduler.core import enumerate_network, ExclMatcher, QueueManager, SchedulerService, sixenum_target_boundaries
+from sner.server.scheduler.core import (
+    enumerate_network,
+    ExclMatcher,
+    get_excl_matcher,
+    JobManager,
+    QueueManager,
+    SchedulerService,
+    sixenum_target_boundaries
+)
 from sner.server.scheduler.models import Heatmap, Job, Readynet
 
 
@@ -28,6 +37,9 @@ def test_enumerate_network():
 
     assert 'fe80::1:3' in enumerate_network('fe80::1:0/126')
 
+    output = enumerate_network('127.0.3.0/30')
+    assert output == ['127.0.3.0', '127.0.3.1', '127.0.3.2', '127.0.3.3']
+
 
 def test_sixenum_target_boundaries():
     """check sixenum_target_boundaries"""
@@ -77,6 +89,17 @@ def test_excl_matcher(app):  # pylint: disable=unused-argument
         repr(item)
 
 
+def test_get_excl_matcher(app):
+    """test cached exclusion matcher"""
+
+    matcher = get_excl_matcher(app)
+    assert get_excl_matcher(app) is matcher
+
+    app.config['SNER_EXCLUSIONS'] = [['regex', 'notarget']]
+    assert get_excl_matcher(app) is not matcher
+    assert get_excl_matcher(app).match('notarget')
+
+
 def test_queuemanager_errorhandling(app, queue):  # pylint: disable=unused-argument
     """test QueuemaManger error handling"""
 
@@ -88,6 +111,18 @@ def test_queuemanager_errorhandling(app, queue):  # pylint: disable=unused-argum
     assert 'failed to remove queue directory' in str(pytest_wrapped_e)
 
 
+def test_jobmanager_reconcile_notargets(app, job_factory):  # pylint: disable=unused-argument
+    """test JobManager reconcile job without targets"""
+
+    job = job_factory.create(assignment=json.dumps({'module': 'dummy', 'targets': []}))
+    assert not job.targets
+
+    JobManager.reconcile(job)
+
+    assert job.retval == -1
+    assert Heatmap.query.count() == 0
+
+
 def test_schedulerservice_hashval():
     """test heatmap hashval computation"""
 
@@ -148,6 +183,29 @@ def test_schedulerservice_morereadynetupdates(app, queue, target_factory):  # py
     assert Readynet.query.count() == 1
 
 
+def test_schedulerservice_multipletargetsperhashval(app, queue, target_factory):  # pylint: disable=unused-argument
+    """test scheduler service heatmap accounting for job with multiple targets within same hashval"""
+
+    current_app.config['SNER_HEATMAP_HOT_LEVEL'] = 3
+    queue.group_size = 4
+
+    for addr in range(1, 5):
+        tmp = f'127.0.0.{addr}'
+        target_factory.create(queue=queue, target=tmp, hashval=SchedulerService.hashval(tmp))
+    db.session.commit()
+
+    assignment = SchedulerService.job_assign(None, [])
+
+    assert len(assignment['targets']) == 3
+    assert Heatmap.query.one().count == 3
+    assert Readynet.query.count() == 0
+
+    SchedulerService.job_output(Job.query.get(assignment['id']), 0, b'')
+    assert Heatmap.query.count() == 0
+    assert Readynet.query.count() == 1
+    assert SchedulerService.heatmap_check()
+
+
 def test_schedulerservice_hashvalprocessing(app, queue, target_factory):  # pylint: disable=unused-argument
     """test scheduler service hashvalsreadynet manipulation"""
 
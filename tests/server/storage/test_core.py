@@ -3,6 +3,8 @@
 storage.core functions tests
 """
 
+import json
+
 import pytest
 
 from sner.server.parser import ParsedItemsDb
@@ -38,6 +40,33 @@ def test_importparsed(app):  # pylint: disable=unused-argument
     assert host.notes[0].tags == ['testtag']
 
 
+def test_importparsed_existing(app):  # pylint: disable=unused-argument
+    """test import parsed into existing objects"""
+
+    def build_pidb(hostname):
+        pidb = ParsedItemsDb()
+        pidb.upsert_host('192.0.2.1', hostnames=[hostname])
+        pidb.upsert_vuln('192.0.2.1', 'name1', 'xtype1', 'tcp', 80, 'target1', severity=SeverityEnum.INFO, data='data1')
+        pidb.upsert_note('192.0.2.1', 'xtype1', 'tcp', 80, 'target1', data='data1')
+        return pidb
+
+    StorageManager.import_parsed(build_pidb('host1.example.com'), ['tag1'])
+    StorageManager.import_parsed(build_pidb('host2.example.com'), ['tag2'])
+
+    assert Host.query.count() == 1
+    assert Service.query.count() == 1
+    assert Vuln.query.count() == 1
+    assert Note.query.count() == 2
+
+    host = Host.query.one()
+    assert sorted(host.tags) == ['tag1', 'tag2']
+    assert sorted(host.services[0].tags) == ['tag1', 'tag2']
+    assert sorted(host.vulns[0].tags) == ['tag1', 'tag2']
+    assert sorted(Note.query.filter(Note.xtype == 'xtype1').one().tags) == ['tag1', 'tag2']
+    hostnames_note = Note.query.filter(Note.xtype == 'hostnames').one()
+    assert sorted(json.loads(hostnames_note.data)) == ['host1.example.com', 'host2.example.com']
+
+
 def test_storagecleanup(app, host_factory, service_factory, vuln_factory, note_factory):  # pylint: disable=unused-argument
     """test planners cleanup storage stage"""
 
@@ -46,12 +75,13 @@ def test_storagecleanup(app, host_factory, service_factory, vuln_factory, note_f
     StorageManager.cleanup_storage()
     assert Host.query.count() == 0
 
-    # host2
+    # host2, other note on different host must not prevent cleanup
     host2 = host_factory.create(address='127.127.127.136', hostname=None, os=None, comment=None)
     note_factory.create(host=host2, xtype='hostnames', data='adata')
+    note_factory.create(host=host_factory.create(address='127.127.127.137', os='identified'), xtype='other')
     StorageManager.cleanup_storage()
-    assert Host.query.count() == 0
-    assert Note.query.count() == 0
+    assert Host.query.count() == 1
+    assert Note.query.count() == 1
 
     # host3
     host3 = host_factory.create(address='127.127.127.135', os='identified')
@@ -63,10 +93,10 @@ def test_storagecleanup(app, host_factory, service_factory, vuln_factory, note_f
     vuln_factory.create(host=host3, service=service4)
 
     StorageManager.cleanup_storage()
-    assert Host.query.count() == 1
+    assert Host.query.count() == 2
     assert Service.query.count() == 1
     assert Vuln.query.count() == 2
-    assert Note.query.count() == 0
+    assert Note.query.count() == 1
 
 
 def test_vuln_report(app, host_factory, service_factory, vuln_factory):  # pylint: disable=unused-argument